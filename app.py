@@ -1,123 +1,618 @@
-import streamlit as st
-import google.generativeai as genai
-
-# ---------- Must be the very first Streamlit call ----------
-st.set_page_config(
-    page_title="🏠 AI Real Estate Analyst Pro",
-    layout="centered",
-    page_icon="🏡"
-)
-
-# ======================
-# SECRETS CONFIGURATION
-# ======================
-def get_api_key():
-    try:
-        if not hasattr(st, 'secrets'):
-            st.error("Streamlit secrets not available in this environment")
-            st.stop()
-        
-        if 'GEMINI_API_KEY' not in st.secrets:
-            st.error(
-                """
-                🔐 Missing API Key Configuration
-                
-                REQUIRED STEPS:
-                
-                1. Go to your Streamlit app dashboard
-                2. Click on 'Settings' → 'Secrets'
-                3. Add exactly this configuration:
-                
-                ```toml
-                [secrets]
-                GEMINI_API_KEY = "your_actual_key_here"
-                ```
-                
-                4. Click 'Save' 
-                5. Wait 1 minute and refresh this page
-                """
-            )
-            st.stop()
-            
-        return st.secrets["GEMINI_API_KEY"]
-        
-    except Exception as e:
-        st.error(f"Configuration error: {str(e)}")
-        st.stop()
-
-# ======================
-# APP INITIALIZATION
-# ======================
-def initialize_gemini():
-    try:
-        api_key = get_api_key()
-        genai.configure(api_key=api_key)
-        return genai.GenerativeModel("models/gemini-1.5-pro-latest")
-    except Exception as e:
-        st.error(f"Failed to initialize Gemini: {str(e)}")
-        st.stop()
-
-# ======================
-# MAIN APP
-# ======================
-def main():
-    # (Optionally, if you need debugging, place such debugging outputs here)
-    # st.write("🔍 Secrets loaded:", st.secrets)
-    
-    # Initialize services
-    model = initialize_gemini()
-    
-    if "chat_history" not in st.session_state:
-        st.session_state.chat_history = []
-    
-    st.title("🏠 AI Real Estate Analyst Pro")
-    
-    for msg in st.session_state.chat_history:
-        with st.chat_message(msg["role"]):
-            st.markdown(msg["content"])
-    
-    if not st.session_state.chat_history:
-        welcome_msg = """
-        🏡 **Professional Real Estate Assistant**  
-        I specialize in:
-        - Accurate property valuations
-        - Local market analytics
-        - Investment opportunity analysis
-        - Comparative market reports
-        
-        Try asking:  
-        *"What's the current price per sqft in Downtown Miami?"*  
-        *"Show me investment opportunities in Austin under $500k"*
-        """
-        st.session_state.chat_history.append({"role": "assistant", "content": welcome_msg})
-        with st.chat_message("assistant"):
-            st.markdown(welcome_msg)
-    
-    if prompt := st.chat_input("Ask about properties..."):
-        st.session_state.chat_history.append({"role": "user", "content": prompt})
-        with st.chat_message("user"):
-            st.markdown(prompt)
-        
-        with st.chat_message("assistant"):
-            with st.spinner("Analyzing market data..."):
-                try:
-                    response = model.generate_content(
-                        f"""As a certified real estate analyst, provide detailed insights about:
-                        {prompt}
-                        
-                        Include:
-                        1. Location-specific context 🌍
-                        2. Current market metrics 📊  
-                        3. Professional recommendations 💼
-                        4. Risk assessment ⚠️
-                        """
-                    )
-                    reply = response.text
-                except Exception as e:
-                    reply = f"⚠️ Service Error: {str(e)}"
-                
-                st.markdown(reply)
-                st.session_state.chat_history.append({"role": "assistant", "content": reply})
-
-if __name__ == "__main__":
-    main()
+import asyncio
+import collections
+import datetime
+import functools
+import hashlib
+import itertools
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+
+import streamlit as st
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+# Compiled once at import; a single alternation scans the message once
+# instead of running four separate searches over the same text.
+_PROPERTY_RE = re.compile(
+    r'in\s+(?P<location>\S+)'
+    r'|(?P<size>\d+)\s*(?:sqft|square\s*feet)'
+    r'|(?P<beds>\d+)\s*bed'
+    r'|\$?(?P<price>\d{1,3}(?:,\d{3})*)',
+    re.IGNORECASE,
+)
+
+# Cheap gate run before extraction; most chat turns are questions, not
+# valuations, and skip the property scan entirely.
+_VAL_KW = re.compile(r'\b(?:worth|value|price|valuation|buy)\b', re.IGNORECASE)
+
+# ---------- Must be the very first Streamlit call ----------
+st.set_page_config(
+    page_title="🏠 AI Real Estate Analyst Pro",
+    layout="centered",
+    page_icon="🏡"
+)
+
+# ======================
+# SECRETS CONFIGURATION
+# ======================
+@functools.lru_cache(maxsize=1)
+def _load_env():
+    # .env is stat'd and parsed exactly once per process, not on every
+    # Streamlit rerun.
+    load_dotenv()
+    return True
+
+@st.cache_resource
+def get_api_key():
+    # Resolved once per process; reruns don't touch st.secrets or
+    # os.environ again.
+    _load_env()
+    try:
+        key = st.secrets.get("GEMINI_API_KEY")
+    except Exception:
+        # No secrets.toml at all (the normal local case) — fall
+        # through to the environment rather than stopping the app.
+        key = None
+    key = key or os.getenv("GEMINI_API_KEY")
+
+    if not key:
+        st.error(
+            """
+            🔐 Missing API Key Configuration
+
+            REQUIRED STEPS:
+
+            1. Go to your Streamlit app dashboard
+            2. Click on 'Settings' → 'Secrets'
+            3. Add exactly this configuration:
+
+            ```toml
+            [secrets]
+            GEMINI_API_KEY = "your_actual_key_here"
+            ```
+
+            4. Click 'Save'
+            5. Wait 1 minute and refresh this page
+            """
+        )
+        st.stop()
+
+    return key
+
+# ======================
+# APP INITIALIZATION
+# ======================
+# Role preamble sent with every request, kept verbose (including the
+# worked examples) to nudge it toward Gemini's minimum cached-token
+# threshold. It is still far below the ~32k-token floor for explicit
+# caching on the 1.5 models, so in practice the inline
+# system_instruction fallback in get_model is the live path; the
+# CachedContent attempt starts paying off only if this preamble ever
+# grows past the threshold.
+REAL_ESTATE_CONTEXT = """You are a certified real estate analyst assisting buyers,
+sellers and investors. For every question you answer:
+
+1. Ground the answer in location-specific context 🌍 — neighborhood
+   character, school districts, commute patterns, zoning and local
+   regulation where relevant.
+2. Cite current market metrics 📊 — median sale price, price per
+   square foot, days on market, inventory months, rent yields — and be
+   explicit when a figure is an estimate rather than a live quote.
+3. Give professional recommendations 💼 — concrete next steps such as
+   comparable properties to review, negotiation ranges, financing
+   structures or timing considerations.
+4. Close with a risk assessment ⚠️ — interest-rate exposure, vacancy
+   risk, natural-hazard or insurance considerations, and liquidity.
+
+Worked examples of the expected register:
+
+Q: "Is a 3 bed 2000 sqft house in Austin worth $450,000?"
+A: Summarize Austin's current median price per sqft, compare the
+implied $225/sqft against the submarket, flag which neighborhoods
+skew the average, recommend a comparable-sales check and an
+inspection contingency, then note rate and property-tax risk.
+
+Q: "What's a 1031 exchange?"
+A: Explain the deferral mechanism, the 45-day identification and
+180-day closing windows, the like-kind requirement, when it beats an
+outright sale, and the risks of a failed exchange timeline.
+
+Stay factual, structured and concise; never invent exact live prices."""
+
+# Pro does the real analysis; Flash is several times faster per token
+# and handles greetings and short conversational filler.
+_PRO_MODEL = "models/gemini-1.5-pro-latest"
+_FLASH_MODEL = "models/gemini-1.5-flash-latest"
+
+_SMALL_TALK = re.compile(r"\b(?:hi|hello|hey|thanks|thank you|bye)\b", re.IGNORECASE)
+
+def is_small_talk(prompt):
+    return len(prompt) < 40 or _SMALL_TALK.search(prompt) is not None
+
+@st.cache_resource
+def get_model(api_key, model_name=_PRO_MODEL):
+    # Built once per (process, model) and shared across sessions and
+    # reruns; avoids re-running credential setup on every interaction.
+    # Imported lazily: the grpc/protobuf tree is heavy, and deferring
+    # it lets the UI skeleton paint before the SDK loads.
+    import google.generativeai as genai
+
+    # Explicit gRPC transport: one HTTP/2 channel is established here
+    # and multiplexed for every subsequent call, so no per-call TLS
+    # handshake. The cache_resource lifetime keeps the channel alive
+    # for the whole process. The sentinel stops the second model
+    # variant (Pro/Flash each get a cache entry) from re-running
+    # global configuration and churning the channel pool.
+    if not getattr(genai, "_configured", False):
+        genai.configure(api_key=api_key, transport="grpc")
+        genai._configured = True
+    try:
+        # Explicit context cache: the preamble's tokens are processed
+        # once per TTL server-side instead of on every call. Today
+        # this raises (the preamble is well under the cacheable-token
+        # minimum) and the inline fallback below is the path actually
+        # taken; see the note on REAL_ESTATE_CONTEXT.
+        cached = genai.caching.CachedContent.create(
+            model=model_name,
+            system_instruction=REAL_ESTATE_CONTEXT,
+            ttl=datetime.timedelta(seconds=3600),
+        )
+        return genai.GenerativeModel.from_cached_content(cached)
+    except Exception:
+        # Caching needs a minimum token count and isn't enabled for
+        # every account; fall back to sending the instruction inline.
+        return genai.GenerativeModel(
+            model_name,
+            system_instruction=REAL_ESTATE_CONTEXT,
+        )
+
+def initialize_gemini():
+    try:
+        return get_model(get_api_key())
+    except Exception as e:
+        st.error(f"Failed to initialize Gemini: {str(e)}")
+        st.stop()
+
+# ======================
+# RESPONSE GENERATION
+# ======================
+# Static scaffold built once; each call only pays for the
+# substitution. All constant text sits BEFORE the variable so the
+# request prefix is byte-identical across calls, which is what
+# Gemini's implicit prefix cache keys on.
+_PROMPT_TMPL = """As a certified real estate analyst, provide detailed insights covering:
+1. Location-specific context 🌍
+2. Current market metrics 📊
+3. Professional recommendations 💼
+4. Risk assessment ⚠️
+
+Question:
+{q}
+"""
+
+async def _gather_generate(model, prompts):
+    responses = await asyncio.gather(
+        *[model.generate_content_async(p) for p in prompts]
+    )
+    return [r.text for r in responses]
+
+@st.cache_resource
+def _async_loop():
+    # The SDK's async gRPC client binds to the first event loop it
+    # runs under, and asyncio.run would close that loop on return,
+    # stranding the client for the next call. Keep one loop alive on
+    # a daemon thread for the life of the process instead.
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+def generate_many(prompts):
+    # Independent one-shot analyses go out concurrently instead of
+    # back-to-back; a single prompt is just a gather of one.
+    future = asyncio.run_coroutine_threadsafe(
+        _gather_generate(initialize_gemini(), list(prompts)), _async_loop()
+    )
+    return future.result()
+
+@st.cache_data(ttl=3600, max_entries=500, show_spinner=False)
+def _cached_generate(prompt):
+    # Keyed purely on the prompt text; repeated questions skip the
+    # network round-trip entirely for an hour.
+    return generate_many([prompt])[0]
+
+def generate_response(prompt):
+    try:
+        return _cached_generate(prompt)
+    except Exception as e:
+        # Full traceback goes to the server log; the chat only carries
+        # a capped summary. A multi-KB gRPC traceback stored in history
+        # would be re-parsed on every rerun for the rest of the session.
+        logger.exception("Gemini request failed")
+        return f"⚠️ Service Error: {str(e)[:200]}"
+
+# How many prior turns are replayed when a chat session is (re)built;
+# caps outbound tokens at O(window) rather than O(session length).
+GEMINI_HISTORY_TURNS = 12
+
+def _gemini_history():
+    recent = list(st.session_state.chat_history)[-GEMINI_HISTORY_TURNS:]
+    # Gemini's schema uses "model" where the UI uses "assistant".
+    return [
+        {"role": "model" if m["role"] == "assistant" else "user", "parts": [m["content"]]}
+        for m in recent
+    ]
+
+def get_chat():
+    # One ChatSession per browser session; Gemini keeps the running
+    # context server-side instead of us re-sending it every turn.
+    if "chat" not in st.session_state:
+        st.session_state.chat = initialize_gemini().start_chat(history=_gemini_history())
+    return st.session_state.chat
+
+def stream_chat_message(prompt):
+    # Yield text as Gemini produces it so the first tokens reach the
+    # UI at first-chunk latency instead of full-response latency.
+    for chunk in get_chat().send_message(prompt, stream=True):
+        yield chunk.text
+
+def stream_small_talk(prompt):
+    # Greetings and short follow-ups never justify Pro latency, but
+    # they still need context ("What about Dallas?" is a reference,
+    # not a greeting). Send the same windowed history the Pro session
+    # would see — the pending user turn is already appended to
+    # chat_history, so the window ends with it.
+    model = get_model(get_api_key(), _FLASH_MODEL)
+    for chunk in model.generate_content(_gemini_history(), stream=True):
+        yield chunk.text
+
+def coalesce(chunks, max_delay=0.02, min_chars=16):
+    # Gemini can emit very small chunks; flushing each one to the
+    # frontend causes re-render thrash. Buffer until enough characters
+    # accumulate or the cadence elapses, then emit one piece.
+    buf = []
+    size = 0
+    last = time.monotonic()
+    for text in chunks:
+        buf.append(text)
+        size += len(text)
+        if size >= min_chars or time.monotonic() - last > max_delay:
+            yield "".join(buf)
+            buf.clear()
+            size = 0
+            last = time.monotonic()
+    if buf:
+        yield "".join(buf)
+
+# ======================
+# INPUT PARSING
+# ======================
+def extract_property_details(text):
+    details = {}
+    for match in _PROPERTY_RE.finditer(text):
+        key = match.lastgroup
+        if key not in details:
+            details[key] = match.group(key)
+    return details
+
+# ======================
+# PAGE STYLE
+# ======================
+@st.cache_data(show_spinner=False)
+def css_block():
+    return """
+    <style>
+    .stChatMessage { border-radius: 12px; }
+    section[data-testid="stSidebar"] .stMarkdown { font-size: 0.92rem; }
+    </style>
+    """
+
+def inject_css():
+    # Emitted every rerun on purpose: Streamlit drops any element that
+    # a rerun doesn't re-emit, so a once-per-session guard would strip
+    # the styling from the second interaction onward. The string
+    # itself is cached; the delta is a few hundred bytes.
+    st.markdown(css_block(), unsafe_allow_html=True)
+
+# ======================
+# SIDEBAR
+# ======================
+@st.cache_data(show_spinner=False)
+def build_valuation_prompt(property_type, bedrooms, location):
+    question = (
+        f"Provide a detailed valuation estimate for a {bedrooms}-bedroom "
+        f"{property_type.lower()} in {location}."
+    )
+    return _PROMPT_TMPL.format_map({"q": question})
+
+@st.cache_data(show_spinner=False)
+def build_trends_prompt(location, horizon):
+    question = f"Summarize residential market trends in {location} over the {horizon.lower()}."
+    return _PROMPT_TMPL.format_map({"q": question})
+
+@st.cache_data(show_spinner=False)
+def build_investment_prompt(location, budget):
+    question = f"Identify promising investment opportunities in {location} under ${budget:,.0f}."
+    return _PROMPT_TMPL.format_map({"q": question})
+
+def _run_form(kind, key_tuple, prompt):
+    # Resubmitting the same inputs reuses the previous reply without
+    # re-entering the generate path at all.
+    key = (kind,) + key_tuple
+    if st.session_state.get("last_form_key") != key:
+        st.session_state.last_form_key = key
+        st.session_state.last_form_reply = generate_response(prompt)
+    st.markdown(st.session_state.last_form_reply)
+
+@st.fragment
+def render_sidebar_tools():
+    # As a fragment, interactions in here rerun only this function,
+    # not the whole script (chat turns still refresh it as part of the
+    # full rerun). The caller wraps it in `with st.sidebar:` — calling
+    # st.sidebar *inside* a fragment is unsupported and raises.
+    st.subheader("🔎 Parsed Property Details")
+    details = st.session_state.get("property_details") or {}
+    if details:
+        for key, value in details.items():
+            st.markdown(f"**{key.title()}:** {value}")
+    else:
+        st.caption("Ask about a property to see parsed details here.")
+
+    st.divider()
+    st.subheader("🏷️ Quick Valuation")
+    with st.form("valuation_form"):
+        property_type = st.selectbox(
+            "Property type", ["House", "Condo", "Townhouse", "Multi-family"]
+        )
+        bedrooms = st.number_input("Bedrooms", min_value=1, max_value=10, value=3)
+        location = st.text_input("Location", placeholder="e.g. Austin, TX")
+        submitted = st.form_submit_button("Estimate")
+    if submitted and location:
+        loc = location.strip()
+        _run_form(
+            "valuation",
+            (property_type, bedrooms, loc),
+            build_valuation_prompt(property_type, bedrooms, loc),
+        )
+
+    st.subheader("📈 Market Trends")
+    with st.form("trends_form"):
+        trends_location = st.text_input("Location", key="trends_loc")
+        horizon = st.selectbox("Horizon", ["Last 12 months", "Last 5 years"])
+        trends_submitted = st.form_submit_button("Analyze")
+    if trends_submitted and trends_location:
+        loc = trends_location.strip()
+        _run_form("trends", (loc, horizon), build_trends_prompt(loc, horizon))
+
+    st.subheader("💼 Investment Scan")
+    with st.form("investment_form"):
+        invest_location = st.text_input("Location", key="invest_loc")
+        budget = st.number_input(
+            "Budget ($)", min_value=50_000, max_value=10_000_000,
+            value=500_000, step=50_000,
+        )
+        invest_submitted = st.form_submit_button("Scan")
+    if invest_submitted and invest_location:
+        loc = invest_location.strip()
+        _run_form("investment", (loc, budget), build_investment_prompt(loc, budget))
+
+# ======================
+# SESSION PERSISTENCE
+# ======================
+_HISTORY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".chat_cache")
+
+def _session_key():
+    # Derived from the browser's cookies so the same visitor maps to
+    # the same transcript even after a server restart; falls back to a
+    # per-session id when no cookies are available.
+    try:
+        raw = "|".join(f"{k}={v}" for k, v in sorted(st.context.cookies.items()))
+    except Exception:
+        raw = ""
+    if not raw:
+        return st.session_state.setdefault("sid", uuid.uuid4().hex)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+@st.cache_resource
+def _history_db():
+    # One connection per process. Appends are single INSERTs and loads
+    # are LIMIT-ed SELECTs, so persistence cost no longer scales with
+    # transcript length the way rewriting a whole JSON blob did.
+    os.makedirs(_HISTORY_DIR, exist_ok=True)
+    conn = sqlite3.connect(
+        os.path.join(_HISTORY_DIR, "chat.db"), check_same_thread=False
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS messages ("
+        "session_id TEXT, ts REAL, role TEXT, content TEXT)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_session "
+        "ON messages (session_id, ts)"
+    )
+    conn.commit()
+    return conn
+
+def load_history(session_key, limit=50):
+    try:
+        rows = _history_db().execute(
+            "SELECT role, content FROM messages WHERE session_id = ? "
+            "ORDER BY ts DESC LIMIT ?",
+            (session_key, limit),
+        ).fetchall()
+    except (sqlite3.Error, OSError):
+        return []
+    return [{"role": role, "content": content} for role, content in reversed(rows)]
+
+def save_message(session_key, role, content):
+    try:
+        db = _history_db()
+        db.execute(
+            "INSERT INTO messages (session_id, ts, role, content) VALUES (?, ?, ?, ?)",
+            (session_key, time.time(), role, content),
+        )
+        db.commit()
+    except (sqlite3.Error, OSError):
+        # Read-only filesystems just lose warm-restart continuity.
+        pass
+
+# ======================
+# MAIN APP
+# ======================
+# Only this many messages are kept in the rendered window; rerun cost
+# stays bounded no matter how long the session runs.
+CHAT_WINDOW = 40
+
+# Messages beyond this many are tucked into a collapsed expander so
+# each rerun only markdown-parses the recent tail.
+RENDER_LIMIT = 30
+
+# Interned once per worker and shared across sessions instead of being
+# rebuilt in each new session.
+_WELCOME = """
+🏡 **Professional Real Estate Assistant**
+I specialize in:
+- Accurate property valuations
+- Local market analytics
+- Investment opportunity analysis
+- Comparative market reports
+
+Try asking:
+*"What's the current price per sqft in Downtown Miami?"*
+*"Show me investment opportunities in Austin under $500k"*
+"""
+
+def _render_messages(messages):
+    # One chat bubble (and one frontend delta) per run of same-role
+    # messages instead of one per message. The single-HTML-block
+    # variant had to escape content, which rendered replayed replies
+    # as literal markdown source; grouped batching keeps most of the
+    # delta reduction without losing formatting.
+    for role, group in itertools.groupby(messages, key=lambda m: m["role"]):
+        with st.chat_message(role):
+            st.markdown("\n\n---\n\n".join(m["content"] for m in group))
+
+def append_message(role, content):
+    st.session_state.chat_history.append({"role": role, "content": content})
+    st.session_state.chat_archive.append({"role": role, "content": content})
+    save_message(_session_key(), role, content)
+
+def main():
+    # (Optionally, if you need debugging, place such debugging outputs here)
+    # st.write("🔍 Secrets loaded:", st.secrets)
+    
+    # Initialize services (surfaces configuration errors up front)
+    initialize_gemini()
+
+    if "chat_history" not in st.session_state:
+        # Rehydrate from disk so a server restart doesn't wipe context.
+        saved = load_history(_session_key())
+        st.session_state.chat_history = collections.deque(saved, maxlen=CHAT_WINDOW)
+        # Full transcript, never rendered; the deque is the display window.
+        st.session_state.chat_archive = list(saved)
+
+    # Build the chat session before this rerun's input is appended so
+    # the pending message isn't replayed as history and sent again.
+    get_chat()
+    
+    st.title("🏠 AI Real Estate Analyst Pro")
+    inject_css()
+    with st.sidebar:
+        render_sidebar_tools()
+    
+    # Check against the archive (which never evicts) stops a rerun
+    # race — or a rehydrated transcript — from re-appending the
+    # welcome. Equality, not identity: reloaded strings are new objects.
+    # Appended before the replay loop so that loop stays the sole
+    # renderer and the welcome is never markdown-parsed twice.
+    if not st.session_state.chat_history and not any(
+        m["content"] == _WELCOME for m in st.session_state.chat_archive
+    ):
+        append_message("assistant", _WELCOME)
+
+    history = list(st.session_state.chat_history)
+    older, recent = history[:-RENDER_LIMIT], history[-RENDER_LIMIT:]
+    if older:
+        with st.expander(f"Earlier messages ({len(older)} hidden)"):
+            _render_messages(older)
+    _render_messages(recent)
+    
+    if prompt := st.chat_input("Ask about properties..."):
+        append_message("user", prompt)
+        with st.chat_message("user"):
+            st.markdown(prompt)
+
+        if _VAL_KW.search(prompt):
+            st.session_state.property_details = extract_property_details(prompt)
+        
+        with st.chat_message("assistant"):
+            # The analyst scaffold lives in REAL_ESTATE_CONTEXT (cached
+            # server-side); sending the bare message keeps the request
+            # prefix byte-identical across turns for implicit caching.
+            # A placeholder filled as chunks arrive shows first bytes at
+            # first-token latency; the spinner only ever showed a stall.
+            placeholder = st.empty()
+            text_buf = ""
+            status = None
+            try:
+                streamer = stream_small_talk if is_small_talk(prompt) else stream_chat_message
+                # Stage labels give a progress signal where the old
+                # spinner showed an opaque stall (which users read as a
+                # hang and retry, multiplying load).
+                with st.status("Analyzing market data...", expanded=False) as status:
+                    status.update(label="Contacting Gemini…")
+                    # Every markdown() reparses the whole reply
+                    # client-side, so flush at most every 8 pieces or
+                    # 50 ms; the label updates ride the same throttle.
+                    last_flush = time.monotonic()
+                    pending = 0
+                    for piece in coalesce(streamer(prompt)):
+                        text_buf += piece
+                        pending += 1
+                        if pending >= 8 or time.monotonic() - last_flush > 0.05:
+                            placeholder.markdown(text_buf + "▌")
+                            status.update(label=f"Streaming ({len(text_buf)} characters)")
+                            pending = 0
+                            last_flush = time.monotonic()
+                    status.update(label="Done", state="complete")
+                placeholder.markdown(text_buf)
+                reply = text_buf
+            except Exception as e:
+                # A failed stream leaves the ChatSession holding a
+                # broken response, and every later send_message on it
+                # raises (BrokenResponseError / IncompleteIteration-
+                # Error). Always drop the session chat so the next
+                # turn rebuilds it from the rendered transcript.
+                st.session_state.pop("chat", None)
+                # An expired context cache additionally needs the
+                # cached model rebuilt.
+                if "CachedContent" in str(e) or "not found" in str(e).lower():
+                    get_model.clear()
+                if status is not None:
+                    status.update(label="Failed", state="error")
+                # Keep whatever streamed before the failure instead of
+                # discarding a partially delivered answer. Truncated:
+                # an unbounded traceback appended to history would be
+                # re-rendered on every rerun forever.
+                logger.exception("Gemini stream failed")
+                reply = f"⚠️ Service Error: {str(e)[:200]}"
+                if text_buf:
+                    reply = f"{text_buf}\n\n{reply}"
+                placeholder.markdown(reply)
+            append_message("assistant", reply)
+            # The Pro ChatSession never saw a Flash-handled exchange;
+            # drop it so the next analysis turn rebuilds its history
+            # from the rendered transcript instead of diverging.
+            if streamer is stream_small_talk:
+                st.session_state.pop("chat", None)
+            # Rerun so the history loop becomes the one renderer of the
+            # finished turn and the transient status box is cleared.
+            st.rerun()
+
+if __name__ == "__main__":
+    main()